@@ -1,18 +1,40 @@
 import os
 import sys
 import uuid
+import time
 import asyncio
+import random
 import httpx
 import json
+import re
+import orjson
 import smtplib
+import sqlite3
+import threading
 import logging
+import logging.handlers
+import queue
+import atexit
+import hashlib
+import weakref
+from collections import OrderedDict
 from email.message import EmailMessage
-from datetime import datetime
+from functools import lru_cache, wraps
 from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters, BaseHandler
+from telegram.error import TelegramError
+from telegram.ext import AIORateLimiter, Application, CommandHandler, MessageHandler, ContextTypes, PersistenceInput, PicklePersistence, filters
 
 # --- Set up basic logging ---
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+# Handlers only enqueue records; a listener thread does the stdout writes, so a full log pipe never stalls the event loop.
+LOG_QUEUE: queue.SimpleQueue = queue.SimpleQueue()
+log_output = logging.StreamHandler()
+log_output.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+LOG_LISTENER = logging.handlers.QueueListener(LOG_QUEUE, log_output)
+log_input = logging.handlers.QueueHandler(LOG_QUEUE)
+log_input.setFormatter(logging.Formatter('%(message)s')) # The listener's handler adds the timestamp and level
+logging.basicConfig(handlers=[log_input], level=logging.INFO)
+LOG_LISTENER.start()
+atexit.register(LOG_LISTENER.stop) # Flushes queued records, including a fatal error logged just before sys.exit
 logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
@@ -26,10 +48,105 @@ SMTP_SERVER = os.getenv("SMTP_SERVER")
 SMTP_PORT = int(os.getenv("SMTP_PORT", 587))
 SMTP_USERNAME = os.getenv("SMTP_USERNAME")
 SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL") # Public HTTPS base URL; when set, Telegram pushes updates instead of being polled
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") # Optional; Telegram echoes it in a header so forged updates are rejected
+PORT = int(os.getenv("PORT", 8443))
+PERSISTENCE_FILE = os.getenv("PERSISTENCE_FILE") # Optional pickle file so in-flight conversations survive restarts and deploys
+RESPONSE_CACHE_DB_PATH = os.getenv("RESPONSE_CACHE_DB") # Optional SQLite file so cached AI replies survive restarts
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", 86400))
+RESPONSE_CACHE_ENABLED = os.getenv("DISABLE_RESPONSE_CACHE") != "1"
+SMTP_CONFIGURED = bool(SMTP_USERNAME and SMTP_PASSWORD and SMTP_SERVER and SENDER_EMAIL)
 
 if not TELEGRAM_TOKEN or not OPENROUTER_API_KEY:
     raise ValueError("FATAL: OpenRouter or Telegram environment variables are not set.")
 
+# --- OPENROUTER REQUEST CONSTANTS ---
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+OPENROUTER_HEADERS = {"Authorization": f"Bearer {OPENROUTER_API_KEY}", "Content-Type": "application/json"}
+HTTP_CONNECT_RETRIES = 3
+HTTP_KEEPALIVE_EXPIRY = 60.0
+OPENROUTER_MODEL = os.getenv("OPENROUTER_MODEL", "openai/gpt-4o-mini")
+# Used for turns that never feed a clinic report (e.g. questions asked before consent).
+OPENROUTER_LIGHT_MODEL = os.getenv("OPENROUTER_LIGHT_MODEL", OPENROUTER_MODEL)
+# Every model a patient's words can reach, as named in the consent notice.
+DISCLOSED_AI_MODELS = " and ".join(f"`{model}`" for model in dict.fromkeys((OPENROUTER_MODEL, OPENROUTER_LIGHT_MODEL)))
+OPENROUTER_MAX_TOKENS = 300 # Fits a typical four-key JSON reply; longer ones are caught by the truncation retry below
+OPENROUTER_SHORT_MAX_TOKENS = 200
+# A reply cut off at max_tokens is invalid JSON, so it is retried once with this cap.
+# The longest scripted wellness line (~630 chars, ~160 tokens) plus a cumulative summary fits well within it.
+OPENROUTER_TRUNCATED_RETRY_MAX_TOKENS = 800
+OPENROUTER_TEMPERATURE = 0.3
+# Request fields shared by every completion; query_openrouter only adds the per-call ones.
+OPENROUTER_BASE_PAYLOAD = {"response_format": {"type": "json_object"}, "temperature": OPENROUTER_TEMPERATURE}
+OPENROUTER_TIMEOUT = httpx.Timeout(30.0, connect=5.0)
+OPENROUTER_MAX_ATTEMPTS = 3
+RETRYABLE_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+# A pooled connection the server dropped mid-request; the transport only retries failures to connect.
+RETRYABLE_TRANSPORT_ERRORS = (httpx.RemoteProtocolError, httpx.ReadError, httpx.WriteError)
+OPENROUTER_RETRY_BASE_DELAY = 0.25 # Seconds; doubled per attempt, plus up to this much random jitter
+OPENROUTER_RETRY_MAX_DELAY = 2.0
+OPENROUTER_MAX_RETRY_AFTER = 5.0 # A longer Retry-After fails the turn rather than parking the chat (and the shared bucket) for it
+RESPONSE_CACHE_SIZE = 1024
+RESPONSE_CACHE_PURGE_INTERVAL = 3600 # Seconds between deletions of expired SQLite rows
+RESPONSE_CACHE_LAST_PURGE = 0.0
+CACHE_PUNCTUATION_RE = re.compile(r"[^\w\s]")
+# Greetings and filler that never change what is being asked; negations and pronouns are deliberately kept.
+CACHE_FILLER_WORDS = frozenset({'a', 'an', 'the', 'please', 'pls', 'hi', 'hello', 'hey', 'thanks', 'thank', 'just', 'um', 'uh'})
+UNCACHEABLE_CATEGORY_WORDS = ('clinical', 'medical') # Backstop on the model's free-text category; CACHEABLE_OPENING_TURNS is the primary check
+UNCACHEABLE_ACTIONS = frozenset({'REPORT'}) # A report's summary describes one patient's query and must never be replayed to another
+STREAM_EDIT_INTERVAL = 1.0 # Seconds between Telegram edits of a streamed reply (Telegram throttles rapid edits)
+OPENROUTER_HISTORY_WINDOW = 20 # Most recent turns sent to the model; the opening context turn is always kept
+OPENROUTER_HISTORY_CHAR_BUDGET = 8000 # Older turns are dropped beyond this, so a few pasted walls of text cannot balloon the prompt
+SUMMARISED_HISTORY_WINDOW = 8 # Turns sent verbatim once older ones are covered by the rolling summary
+ROLLING_SUMMARY_THRESHOLD = 12 # History length at which the model's own summary starts standing in for older turns
+ROLLING_SUMMARY_MIN_CHARS = 40 # Shorter summaries are labels ("Gathering details"), not a record of the facts they would replace
+AI_ERROR_SUMMARIES = frozenset({'AI response was not valid JSON.', 'HTTP Error', 'Unhandled error'})
+MAX_WELLNESS_HISTORY = 50 # Struggles chats never feed a report, so their stored history can be bounded
+
+# Updates processed in parallel, so one user's slow AI call does not stall every other chat.
+CONCURRENT_UPDATES = 32
+# Outgoing messages are throttled to Telegram's limits (30/s overall, 20/min per group) and 429s retried this many times.
+TELEGRAM_RATE_LIMIT_RETRIES = 2
+# getUpdates long-poll: Telegram holds the request open until an update arrives or this many seconds pass.
+POLLING_TIMEOUT = 30
+
+# --- SHARED HTTP CLIENT ---
+# One pooled client for OpenRouter and Semble so keep-alive connections are reused across turns.
+# Connection failures are retried inside the transport, so a dropped socket never surfaces as a failed turn.
+# HTTP/2 lets concurrent chats multiplex their OpenRouter calls over a single TLS connection.
+HTTP_CLIENT = httpx.AsyncClient(
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=HTTP_CONNECT_RETRIES,
+        # httpx drops idle sockets after 5s by default, shorter than a patient's typing pause; keep them for a typical turn gap.
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=HTTP_KEEPALIVE_EXPIRY),
+    ),
+    timeout=30,
+)
+
+# --- SMTP CONNECTION (shared across reports; guarded because emails are sent from worker threads) ---
+SMTP_LOCK = threading.Lock()
+SMTP_CONNECTION: smtplib.SMTP | None = None
+SMTP_LAST_USED = 0.0
+SMTP_IDLE_TIMEOUT = 100 # Seconds; providers such as SendGrid drop idle connections after about two minutes
+SMTP_MAX_MESSAGES_PER_CONNECTION = 100 # Reconnect after this many messages to stay within provider per-session limits
+SMTP_MESSAGES_SENT = 0
+
+# --- AI RESPONSE CACHE (exact match, LRU) ---
+RESPONSE_CACHE: OrderedDict[str, tuple[int, tuple[str, str, str, str]]] = OrderedDict() # key -> (created_at, reply)
+
+# --- BACKGROUND TASKS ---
+# Strong references to fire-and-forget tasks so they are not garbage collected mid-flight.
+BACKGROUND_TASKS: set[asyncio.Task] = set()
+
+# --- PER-CHAT ORDERING ---
+# Updates run concurrently across chats, but one chat's messages must hit its state machine in order.
+# Entries vanish once no handler holds or awaits the lock.
+CHAT_LOCKS: weakref.WeakValueDictionary[int, asyncio.Lock] = weakref.WeakValueDictionary()
+# Updates running or queued per chat. Each one holds a concurrent-update slot, so a flooding chat is answered and dropped past the cap.
+CHAT_PENDING_UPDATES: dict[int, int] = {}
+MAX_PENDING_UPDATES_PER_CHAT = 3
+
 # --- STATE AND DATA KEYS ---
 STATE_KEY = 'conversation_state'
 HISTORY_KEY = 'chat_history'
@@ -41,6 +158,7 @@ CURRENT_APPT_KEY = 'current_appointment'
 TRANSCRIPT_KEY = 'full_transcript'
 MODULE_KEY = 'current_module'
 MODULE_STEP_KEY = 'current_module_step'
+ROLLING_SUMMARY_KEY = 'rolling_summary'
 
 # --- CONVERSATION STATES ---
 STATE_AWAITING_CHOICE = 'awaiting_choice'
@@ -85,6 +203,48 @@ STATE_WELLNESS_DAY_7_PRACTICE = 'wellness_day_7_practice'
 STATE_WELLNESS_STRUGGLES_CHAT_ACTIVE = 'wellness_struggles_chat_active'
 STATE_WELLNESS_DYNAMIC_MODULE = 'wellness_dynamic_module'
 
+# --- REPLY KEYWORDS ---
+CONFIRM_YES_REPLIES = frozenset({'yes', 'y', 'correct', 'confirm'})
+CONFIRM_NO_REPLIES = frozenset({'no', 'n', 'incorrect'})
+TRANSCRIPT_YES_REPLIES = frozenset({'yes', 'y'})
+CONSENT_REPLIES = frozenset({'i agree', 'iagree', 'agree'})
+END_CHAT_WORDS = ('no', 'nope', 'bye', 'end', 'thanks') # Substring matches, so replies like 'nothing else' also end the chat
+# Checked before any AI or email work is spent on a session.
+EMAIL_RE = re.compile(r"[^@\s]+@[^@\s]+\.[^@\s.]+")
+PATIENT_ID_RE = re.compile(r"(?=.*\S)[^@]{8,}") # The ID format is not documented: only the old length rule, minus emails and blank input
+# Bare acknowledgements carry nothing for the model to work with before the patient has described their query.
+ACKNOWLEDGEMENT_RE = re.compile(r"(ok(ay)?|thanks|thank you|got it|sure|yes|fine|cool)[.!]*")
+
+# --- CATEGORY SELECTION ---
+CATEGORY_CHOICE_RE = re.compile(r"\b(1|admin(?:istrative|istration)?|2|prescriptions?|medications?|3|clinical|medical)\b")
+CATEGORY_CHOICES = {'1': 'admin', '2': 'prescription', '3': 'clinical', 'admin': 'admin', 'administrative': 'admin', 'administration': 'admin', 'prescription': 'prescription', 'prescriptions': 'prescription',
+                    'medication': 'prescription', 'medications': 'prescription', 'clinical': 'clinical', 'medical': 'clinical'}
+# Free-text fallback: a reply that matches exactly one of these is routed without asking the user to pick a number.
+CATEGORY_KEYWORD_PATTERNS = {
+    'admin': re.compile(r"\b(appointments?|book(ing)?|cancel|reschedule|invoices?|receipts?)\b"),
+    'prescription': re.compile(r"\b(repeats|refill|prescri\w*|medications?|dose)\b"),
+    'clinical': re.compile(r"\b(pain|bleed\w*|fever|symptoms?|dizzy|chest)\b"),
+}
+# Free-text admin replies that go straight to the appointment change questions; booking a new appointment goes to the chat instead.
+APPOINTMENT_CHANGE_RE = re.compile(r"\b(cancel\w*|reschedul\w*|postpone)\b|\b(change|move)\b.*\bappointments?\b")
+# First history turn for each category; the model and the clinical no-cache rule both read it.
+CATEGORY_OPENING_TURNS = {'admin': "Category: Administrative (Other).", 'prescription': "Category: Prescription/Medication.", 'clinical': "Category: Clinical/Medical."}
+# Only these conversations may be cached; clinical, wellness and pre-consent chats never are.
+CACHEABLE_OPENING_TURNS = frozenset({CATEGORY_OPENING_TURNS['admin'], CATEGORY_OPENING_TURNS['prescription']})
+
+# --- AI RATE LIMITING (per Telegram user token bucket) ---
+AI_RATE_PER_SECOND = 0.5
+AI_BURST = 5
+RATE_LIMIT_BUCKETS: dict[int, tuple[float, float]] = {}
+RATE_LIMIT_PRUNE_INTERVAL = 3600 # Seconds between sweeps dropping users whose bucket has refilled (a missing entry is a full bucket)
+RATE_LIMIT_LAST_PRUNE = 0.0
+# Shared bucket for all OpenRouter calls (key 0 is never a Telegram user ID): bursts queue here instead of turning into 429s.
+OPENROUTER_BUCKET_KEY = 0
+OPENROUTER_RATE_PER_SECOND = int(os.getenv("OPENROUTER_RPM", 120)) / 60
+if OPENROUTER_RATE_PER_SECOND <= 0:
+    raise ValueError("FATAL: OPENROUTER_RPM must be greater than 0.")
+OPENROUTER_BURST = 10
+
 
 def load_system_prompt():
     """Loads the system prompt from an external file."""
@@ -100,7 +260,7 @@ def load_wellness_modules():
     modules = {}
     module_dir = 'wellness_modules'
     if not os.path.exists(module_dir):
-        logger.warning(f"'{module_dir}' directory not found. No dynamic modules will be loaded.")
+        logger.warning("'%s' directory not found. No dynamic modules will be loaded.", module_dir)
         return modules
     
     for filename in os.listdir(module_dir):
@@ -110,44 +270,196 @@ def load_wellness_modules():
                     module_data = json.load(f)
                     if all(k in module_data for k in ['keyword', 'title', 'start_step', 'steps']):
                         modules[module_data['keyword']] = module_data
-                        logger.info(f"Successfully loaded dynamic module: {module_data['title']}")
+                        logger.info("Successfully loaded dynamic module: %s", module_data['title'])
                     else:
-                        logger.warning(f"Skipping invalid module file {filename}: missing required keys.")
+                        logger.warning("Skipping invalid module file %s: missing required keys.", filename)
             except Exception as e:
-                logger.error(f"Error loading module from {filename}: {e}")
+                logger.error("Error loading module from %s: %s", filename, e)
     return modules
 
+def purge_expired_responses(conn: sqlite3.Connection):
+    """Deletes SQLite cache rows older than the TTL, so stored patient wording does not accumulate."""
+    global RESPONSE_CACHE_LAST_PURGE
+    conn.execute("DELETE FROM response_cache WHERE created_at <= ?", (int(time.time()) - RESPONSE_CACHE_TTL,))
+    conn.commit()
+    RESPONSE_CACHE_LAST_PURGE = time.monotonic()
+
+def open_response_cache_db():
+    """Opens the optional SQLite response cache, creating the table if needed."""
+    if not RESPONSE_CACHE_DB_PATH:
+        return None
+    try:
+        conn = sqlite3.connect(RESPONSE_CACHE_DB_PATH, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS response_cache (key TEXT PRIMARY KEY, response TEXT, category TEXT, summary TEXT, action TEXT, created_at INTEGER)")
+        conn.execute("CREATE INDEX IF NOT EXISTS response_cache_created_at ON response_cache (created_at)")
+        purge_expired_responses(conn)
+        logger.info("Persistent response cache enabled at %s", RESPONSE_CACHE_DB_PATH)
+        return conn
+    except sqlite3.Error as e:
+        logger.error("Could not open response cache database %s: %s", RESPONSE_CACHE_DB_PATH, e)
+        return None
+
 WELLNESS_MODULES = load_wellness_modules()
+RESPONSE_CACHE_DB = open_response_cache_db()
 SYSTEM_PROMPT = load_system_prompt()
+# Built once and always sent first, so the invariant prefix is byte-identical across calls for provider prefix caching.
+# The static system prompt is the shared prefix of every request; the breakpoint lets providers that need it (Anthropic) cache it.
+SYSTEM_MESSAGE = {"role": "system", "content": [{"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}]}
+# Part of every response-cache key, so an edited system_prompt.txt never serves replies written under the old prompt.
+SYSTEM_PROMPT_HASH = hashlib.sha256(SYSTEM_PROMPT.encode('utf-8')).hexdigest()
+
+def prune_rate_limit_buckets(now: float):
+    """Drops per-user buckets that have refilled to AI_BURST, so the dict does not keep every user ever seen."""
+    global RATE_LIMIT_LAST_PRUNE
+    RATE_LIMIT_LAST_PRUNE = now
+    for user_id, (tokens, last_seen) in list(RATE_LIMIT_BUCKETS.items()):
+        # The shared OpenRouter bucket may carry a Retry-After penalty, so it is never dropped.
+        if user_id != OPENROUTER_BUCKET_KEY and tokens + (now - last_seen) * AI_RATE_PER_SECOND >= AI_BURST:
+            del RATE_LIMIT_BUCKETS[user_id]
+
+def allow_ai_request(user_id: int, rate: float = AI_RATE_PER_SECOND, burst: int = AI_BURST) -> bool:
+    """Token bucket keyed by Telegram user ID. Returns False when the user has no tokens left."""
+    now = time.monotonic()
+    if now - RATE_LIMIT_LAST_PRUNE > RATE_LIMIT_PRUNE_INTERVAL:
+        prune_rate_limit_buckets(now)
+    tokens, last_seen = RATE_LIMIT_BUCKETS.get(user_id, (burst, now))
+    tokens = min(burst, tokens + (now - last_seen) * rate)
+    if tokens < 1:
+        RATE_LIMIT_BUCKETS[user_id] = (tokens, now)
+        return False
+    RATE_LIMIT_BUCKETS[user_id] = (tokens - 1, now)
+    return True
+
+def guess_category(text: str) -> str | None:
+    """Returns the category whose keywords alone appear in the (lowercased) text, or None if zero or several match."""
+    matches = [name for name, pattern in CATEGORY_KEYWORD_PATTERNS.items() if pattern.search(text)]
+    return matches[0] if len(matches) == 1 else None
+
+def chat_lock(chat_id: int) -> asyncio.Lock:
+    """Returns the lock that serialises updates for one chat."""
+    lock = CHAT_LOCKS.get(chat_id)
+    if lock is None:
+        lock = CHAT_LOCKS[chat_id] = asyncio.Lock()
+    return lock
+
+def serialised_per_chat(handler):
+    """Wraps a handler so a chat's updates are processed one at a time, in arrival order, refusing any past MAX_PENDING_UPDATES_PER_CHAT."""
+    @wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        chat_id = update.effective_chat.id
+        pending = CHAT_PENDING_UPDATES.get(chat_id, 0)
+        if pending >= MAX_PENDING_UPDATES_PER_CHAT:
+            logger.warning("Dropping update for chat %s: %s already pending", chat_id, pending)
+            await update.effective_message.reply_text("I'm still working on your earlier messages. Please wait for my reply before sending more.")
+            return
+        CHAT_PENDING_UPDATES[chat_id] = pending + 1
+        try:
+            async with chat_lock(chat_id):
+                await handler(update, context)
+        finally:
+            remaining = CHAT_PENDING_UPDATES.pop(chat_id) - 1
+            if remaining:
+                CHAT_PENDING_UPDATES[chat_id] = remaining
+    return wrapper
+
+def run_in_background(coro, description: str) -> asyncio.Task:
+    """Schedules a coroutine without awaiting it and logs any failure, since nobody else will see it."""
+    task = asyncio.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+
+    def on_done(finished: asyncio.Task):
+        BACKGROUND_TASKS.discard(finished)
+        if not finished.cancelled() and finished.exception():
+            logger.error("Background task failed (%s): %s", description, finished.exception(), exc_info=finished.exception())
+
+    task.add_done_callback(on_done)
+    return task
+
+async def ai_rate_limited(update: Update) -> bool:
+    """Tells the user to slow down and returns True if they have exceeded their AI request budget."""
+    if allow_ai_request(update.effective_user.id):
+        return False
+    logger.warning("Rate limit hit for user %s", update.effective_user.id)
+    await update.message.reply_text("You're sending messages a little too quickly. Please wait a moment and try again.")
+    return True
 
 async def push_to_semble(patient_email: str, category: str, summary: str, transcript: str):
     if not SEMBLE_API_KEY: raise ValueError("Semble API Key is not configured.")
     SEMBLE_GRAPHQL_URL = "https://open.semble.io/graphql"
     headers = {"x-token": SEMBLE_API_KEY, "Content-Type": "application/json"}
     find_patient_query = "query FindPatientByEmail($search: String!) { patients(search: $search) { data { id } } }"
-    async with httpx.AsyncClient() as client:
-        find_payload = {"query": find_patient_query, "variables": {"search": patient_email}}
-        search_response = await client.post(SEMBLE_GRAPHQL_URL, headers=headers, json=find_payload, timeout=20)
-        search_response.raise_for_status()
-        response_data = search_response.json()
-        if response_data.get("errors"): raise Exception(f"GraphQL error: {response_data['errors']}")
-        patients = response_data.get('data', {}).get('patients', {}).get('data', [])
-        if not patients: raise Exception(f"No patient found in Semble with email: {patient_email}")
-        semble_patient_id = patients[0]['id']
-        logger.info(f"Found Semble Patient ID: {semble_patient_id}")
-        create_record_mutation = "mutation CreateRecord($recordData: CreateFreeTextRecordDataInput!) { createFreeTextRecord(recordData: $recordData) { data { id } error } }"
-        note_question = f"Indie Bot Query: {category}"
-        note_answer = f"**AI Summary:**<br>{summary}<br><br>{transcript}"
-        mutation_variables = {"recordData": {"patientId": semble_patient_id, "question": note_question, "answer": note_answer}}
-        record_payload = {"query": create_record_mutation, "variables": mutation_variables}
-        record_response = await client.post(SEMBLE_GRAPHQL_URL, headers=headers, json=record_payload, timeout=20)
-        record_response.raise_for_status()
-        record_data = record_response.json()
-        if record_data.get("errors") or (record_data.get("data", {}).get("createFreeTextRecord") or {}).get("error"):
-             raise Exception(f"GraphQL error during record creation: {record_data}")
-        logger.info(f"Successfully pushed FreeTextRecord to Semble for Patient ID: {semble_patient_id}")
-
-def send_initial_emails_and_generate_transcripts(patient_id: str, patient_email: str, session_id: str, history: list, category: str, summary: str):
+    find_payload = {"query": find_patient_query, "variables": {"search": patient_email}}
+    search_response = await HTTP_CLIENT.post(SEMBLE_GRAPHQL_URL, headers=headers, content=orjson.dumps(find_payload), timeout=20)
+    search_response.raise_for_status()
+    response_data = orjson.loads(search_response.content)
+    if response_data.get("errors"): raise Exception(f"GraphQL error: {response_data['errors']}")
+    patients = response_data.get('data', {}).get('patients', {}).get('data', [])
+    if not patients: raise Exception(f"No patient found in Semble with email: {patient_email}")
+    semble_patient_id = patients[0]['id']
+    logger.info("Found Semble Patient ID: %s", semble_patient_id)
+    create_record_mutation = "mutation CreateRecord($recordData: CreateFreeTextRecordDataInput!) { createFreeTextRecord(recordData: $recordData) { data { id } error } }"
+    note_question = f"Indie Bot Query: {category}"
+    note_answer = f"**AI Summary:**<br>{summary}<br><br>{transcript}"
+    mutation_variables = {"recordData": {"patientId": semble_patient_id, "question": note_question, "answer": note_answer}}
+    record_payload = {"query": create_record_mutation, "variables": mutation_variables}
+    record_response = await HTTP_CLIENT.post(SEMBLE_GRAPHQL_URL, headers=headers, content=orjson.dumps(record_payload), timeout=20)
+    record_response.raise_for_status()
+    record_data = orjson.loads(record_response.content)
+    if record_data.get("errors") or (record_data.get("data", {}).get("createFreeTextRecord") or {}).get("error"):
+         raise Exception(f"GraphQL error during record creation: {record_data}")
+    logger.info("Successfully pushed FreeTextRecord to Semble for Patient ID: %s", semble_patient_id)
+
+def close_smtp_connection():
+    """QUITs the shared SMTP connection if one is open. Hold SMTP_LOCK while calling it."""
+    global SMTP_CONNECTION
+    if SMTP_CONNECTION is None:
+        return
+    try:
+        SMTP_CONNECTION.quit()
+    except (OSError, smtplib.SMTPException):
+        SMTP_CONNECTION.close()
+    SMTP_CONNECTION = None
+
+def shutdown_smtp_connection():
+    """Closes the shared SMTP connection once any in-flight send has finished; runs in a worker thread at shutdown."""
+    with SMTP_LOCK:
+        close_smtp_connection()
+
+def get_smtp_connection(messages: int = 1) -> smtplib.SMTP:
+    """Returns the shared, logged-in SMTP connection for sending `messages` emails, reconnecting if it has dropped. Hold SMTP_LOCK while using it."""
+    global SMTP_CONNECTION, SMTP_LAST_USED, SMTP_MESSAGES_SENT
+    now = time.monotonic()
+    if SMTP_CONNECTION is not None and now - SMTP_LAST_USED < SMTP_IDLE_TIMEOUT and SMTP_MESSAGES_SENT + messages <= SMTP_MAX_MESSAGES_PER_CONNECTION:
+        try:
+            if SMTP_CONNECTION.noop()[0] == 250:
+                SMTP_LAST_USED = now
+                SMTP_MESSAGES_SENT += messages
+                return SMTP_CONNECTION
+        except OSError as e:
+            logger.info("SMTP connection lost, reconnecting: %s", e)
+    close_smtp_connection()
+    # Port 465 is TLS from the first byte, which saves the STARTTLS round trip and second EHLO.
+    if SMTP_PORT == 465:
+        server = smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT)
+    else:
+        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
+    try:
+        if SMTP_PORT != 465:
+            server.starttls()
+        server.login(SMTP_USERNAME, SMTP_PASSWORD)
+    except Exception:
+        server.close()
+        raise
+    SMTP_CONNECTION = server
+    SMTP_LAST_USED = now
+    SMTP_MESSAGES_SENT = messages
+    logger.info("Opened SMTP connection to %s:%s", SMTP_SERVER, SMTP_PORT)
+    return server
+
+def generate_transcripts(session_id: str, history: list, summary: str) -> tuple[str, str]:
+    """Builds the (Semble HTML, plain-text email) transcripts for a finished query."""
     transcript_for_email = f"Full Conversation Transcript (Session: {session_id})\n\n"
     transcript_for_semble = f"Full Conversation Transcript (Session: {session_id})<br><br>"
     if not history:
@@ -156,16 +468,16 @@ def send_initial_emails_and_generate_transcripts(patient_id: str, patient_email:
         system_line_html = f"[SYSTEM]: User followed a guided workflow.<br>[SUMMARY]: {summary}<br>"
         transcript_for_semble += system_line_html
     else:
-        for message in history:
-            line = f"[{message['role'].upper()}]: {message['text']}"
-            transcript_for_email += f"{line}\n\n"
-            transcript_for_semble += f"{line}<br><br>"
-    
-    if not all([SMTP_USERNAME, SMTP_PASSWORD, SMTP_SERVER, SENDER_EMAIL]):
+        lines = [f"[{message['role'].upper()}]: {message['text']}" for message in history]
+        transcript_for_email += "".join(f"{line}\n\n" for line in lines)
+        transcript_for_semble += "".join(f"{line}<br><br>" for line in lines)
+    return transcript_for_semble, transcript_for_email
+
+def send_initial_emails(patient_id: str, patient_email: str, session_id: str, transcript_for_email: str, category: str, summary: str):
+    if not SMTP_CONFIGURED:
         raise ValueError("SMTP configuration is incomplete.")
-    with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-        server.starttls()
-        server.login(SMTP_USERNAME, SMTP_PASSWORD)
+    with SMTP_LOCK:
+        server = get_smtp_connection(messages=2)
         admin_subject = f"[Indie Bot] {category} Query from: {patient_email} (Patient ID: {patient_id})"
         admin_msg = EmailMessage()
         admin_msg['Subject'] = admin_subject
@@ -174,7 +486,7 @@ def send_initial_emails_and_generate_transcripts(patient_id: str, patient_email:
         admin_msg.set_content(f"Query from {patient_email}...\n\n--- AI-Generated Summary ---\n{summary}")
         admin_msg.add_attachment(transcript_for_email.encode('utf-8'), maintype='text', subtype='plain', filename=f'transcript_{session_id[-6:]}.txt')
         server.send_message(admin_msg)
-        logger.info(f"Admin report successfully emailed to {REPORT_EMAIL}")
+        logger.info("Admin report successfully emailed to %s", REPORT_EMAIL)
         patient_subject = "Indra Clinic: We have received your query"
         patient_msg = EmailMessage()
         patient_msg['Subject'] = patient_subject
@@ -182,16 +494,13 @@ def send_initial_emails_and_generate_transcripts(patient_id: str, patient_email:
         patient_msg['To'] = patient_email
         patient_msg.set_content(f"Dear Patient,\n\nThank you for your message. This email confirms that we have received your query.\n\nA member of our team will review this and get back to you within 72 hours (but hopefully much sooner!).\n\nKind regards,\nThe Indra Clinic Team")
         server.send_message(patient_msg)
-        logger.info(f"Patient confirmation successfully emailed to {patient_email}")
-    
-    return transcript_for_semble, transcript_for_email
+        logger.info("Patient confirmation successfully emailed to %s", patient_email)
 
 def send_transcript_email(patient_email: str, summary: str, transcript: str):
-    if not all([SMTP_USERNAME, SMTP_PASSWORD, SMTP_SERVER, SENDER_EMAIL]):
+    if not SMTP_CONFIGURED:
         raise ValueError("SMTP configuration is incomplete.")
-    with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-        server.starttls()
-        server.login(SMTP_USERNAME, SMTP_PASSWORD)
+    with SMTP_LOCK:
+        server = get_smtp_connection()
         patient_subject = "Indra Clinic: A copy of your recent query"
         patient_msg = EmailMessage()
         patient_msg['Subject'] = patient_subject
@@ -200,46 +509,321 @@ def send_transcript_email(patient_email: str, summary: str, transcript: str):
         patient_msg.set_content(f"CONFIDENTIALITY NOTICE: This email contains sensitive personal health information. Please ensure it is stored securely.\n\nDear Patient,\n\nAs requested, here is the summary and full transcript of your recent query for your records.\n\n**Summary:**\n{summary}\n\nKind regards,\nThe Indra Clinic Team")
         patient_msg.add_attachment(transcript.encode('utf-8'), maintype='text', subtype='plain', filename='transcript_summary.txt')
         server.send_message(patient_msg)
-        logger.info(f"Patient transcript successfully emailed to {patient_email}")
+        logger.info("Patient transcript successfully emailed to %s", patient_email)
+
+def trim_history(history: list, limit: int) -> list:
+    """Keeps the opening context turn plus the most recent `limit` turns."""
+    if len(history) <= limit + 1:
+        return history
+    return history[:1] + history[-limit:]
+
+def fit_history_to_budget(history: list, max_chars: int) -> list:
+    """Drops the oldest turns after the opening context turn until the texts fit in max_chars, always keeping the latest turn."""
+    total = sum(len(turn['text']) for turn in history)
+    start = 1
+    while total > max_chars and start < len(history) - 1:
+        total -= len(history[start]['text'])
+        start += 1
+    return history if start == 1 else history[:1] + history[start:]
+
+def extract_json_object(content: str) -> dict:
+    """Parses the AI reply, salvaging the outermost {...} block if the model wrapped it in prose or code fences."""
+    try:
+        return orjson.loads(content)
+    except orjson.JSONDecodeError:
+        start, end = content.find('{'), content.rfind('}')
+        if start == -1 or end <= start:
+            raise
+        return orjson.loads(content[start:end + 1])
+
+def openrouter_retry_delay(attempt: int, response: httpx.Response | None = None) -> float | None:
+    """Jittered backoff before retrying OpenRouter, honouring a Retry-After in seconds. None means the server asked for too long a wait."""
+    retry_after = response.headers.get("retry-after", "") if response is not None else ""
+    if retry_after.isdigit():
+        delay = float(retry_after)
+    else:
+        delay = min(OPENROUTER_RETRY_BASE_DELAY * 2 ** attempt, OPENROUTER_RETRY_MAX_DELAY) + random.uniform(0, OPENROUTER_RETRY_BASE_DELAY)
+    if response is not None and response.status_code == 429:
+        # Drain the shared bucket so other chats wait out the limit too instead of adding to it, but never beyond the cap.
+        RATE_LIMIT_BUCKETS[OPENROUTER_BUCKET_KEY] = (1 - min(delay, OPENROUTER_MAX_RETRY_AFTER) * OPENROUTER_RATE_PER_SECOND, time.monotonic())
+    return delay if delay <= OPENROUTER_MAX_RETRY_AFTER else None
+
+async def wait_for_openrouter_capacity():
+    """Waits until the shared OpenRouter token bucket has room for one more request."""
+    while not allow_ai_request(OPENROUTER_BUCKET_KEY, OPENROUTER_RATE_PER_SECOND, OPENROUTER_BURST):
+        await asyncio.sleep(1 / OPENROUTER_RATE_PER_SECOND)
+
+async def post_to_openrouter(data: dict) -> httpx.Response:
+    """POSTs a chat completion, retrying with jittered backoff on 429/5xx and on dropped connections."""
+    for attempt in range(OPENROUTER_MAX_ATTEMPTS):
+        await wait_for_openrouter_capacity()
+        try:
+            response = await HTTP_CLIENT.post(OPENROUTER_URL, headers=OPENROUTER_HEADERS, content=orjson.dumps(data), timeout=OPENROUTER_TIMEOUT)
+        except RETRYABLE_TRANSPORT_ERRORS as e:
+            if attempt == OPENROUTER_MAX_ATTEMPTS - 1:
+                raise
+            delay = openrouter_retry_delay(attempt)
+            logger.warning("OpenRouter connection failed (%s), retrying in %.2fs (attempt %s/%s)", e, delay, attempt + 1, OPENROUTER_MAX_ATTEMPTS)
+            await asyncio.sleep(delay)
+            continue
+        if response.status_code not in RETRYABLE_STATUS_CODES or attempt == OPENROUTER_MAX_ATTEMPTS - 1:
+            break
+        delay = openrouter_retry_delay(attempt, response)
+        if delay is None:
+            logger.warning("OpenRouter returned %s with Retry-After %s; not waiting that long", response.status_code, response.headers.get("retry-after"))
+            break
+        logger.warning("OpenRouter returned %s, retrying in %.2fs (attempt %s/%s)", response.status_code, delay, attempt + 1, OPENROUTER_MAX_ATTEMPTS)
+        await asyncio.sleep(delay)
+    response.raise_for_status()
+    return response
+
+def partial_response_text(content: str) -> str | None:
+    """Best-effort decode of the 'response' string value from a JSON object that is still being streamed."""
+    key = content.find('"response"')
+    if key == -1:
+        return None
+    colon = content.find(':', key + len('"response"'))
+    start = content.find('"', colon + 1) if colon != -1 else -1
+    if start == -1:
+        return None
+    end = start + 1
+    while end < len(content) and content[end] != '"':
+        end += 2 if content[end] == '\\' else 1
+    raw = content[start + 1:end]
+    # The stream may stop mid escape sequence (e.g. half of a \uXXXX), so back off a few characters until it decodes.
+    for trim in range(min(len(raw), 6) + 1):
+        try:
+            return orjson.loads(f'"{raw[:len(raw) - trim]}"')
+        except orjson.JSONDecodeError:
+            continue
+    return None
+
+def log_prompt_cache_usage(payload: dict):
+    """Logs how many prompt tokens the provider served from its prompt cache, when the completion reports it."""
+    cached_tokens = ((payload.get("usage") or {}).get("prompt_tokens_details") or {}).get("cached_tokens")
+    if cached_tokens:
+        logger.info("OpenRouter served %s prompt tokens from the provider cache.", cached_tokens)
+
+async def stream_openrouter_content(data: dict, on_partial) -> tuple[str, str | None]:
+    """Streams a chat completion over SSE, passing each longer prefix of the 'response' field to on_partial. Returns (content, finish_reason)."""
+    shown = ""
+    for attempt in range(OPENROUTER_MAX_ATTEMPTS):
+        await wait_for_openrouter_capacity()
+        try:
+            async with HTTP_CLIENT.stream("POST", OPENROUTER_URL, headers=OPENROUTER_HEADERS, content=orjson.dumps({**data, "stream": True}), timeout=OPENROUTER_TIMEOUT) as response:
+                if response.status_code not in RETRYABLE_STATUS_CODES or attempt == OPENROUTER_MAX_ATTEMPTS - 1:
+                    if response.is_error:
+                        await response.aread()
+                        response.raise_for_status()
+                    chunks = []
+                    finish_reason = None
+                    async for line in response.aiter_lines():
+                        # OpenRouter interleaves ': OPENROUTER PROCESSING' keep-alive comments with the data frames.
+                        if not line.startswith("data: "):
+                            continue
+                        payload = line[len("data: "):]
+                        if payload == "[DONE]":
+                            break
+                        frame = orjson.loads(payload)
+                        # The final frame carries usage and may have no choices.
+                        log_prompt_cache_usage(frame)
+                        if not frame.get("choices"):
+                            continue
+                        choice = frame["choices"][0]
+                        chunks.append(choice["delta"].get("content") or "")
+                        finish_reason = choice.get("finish_reason") or finish_reason
+                        partial = partial_response_text("".join(chunks))
+                        if partial and len(partial) > len(shown):
+                            shown = partial
+                            await on_partial(partial)
+                    return "".join(chunks), finish_reason
+                delay = openrouter_retry_delay(attempt, response)
+                if delay is None:
+                    logger.warning("OpenRouter returned %s with Retry-After %s; not waiting that long", response.status_code, response.headers.get("retry-after"))
+                    await response.aread()
+                    response.raise_for_status()
+                logger.warning("OpenRouter returned %s, retrying in %.2fs (attempt %s/%s)", response.status_code, delay, attempt + 1, OPENROUTER_MAX_ATTEMPTS)
+        except RETRYABLE_TRANSPORT_ERRORS as e:
+            # Once text has reached the user a restart would garble the edited message, so only early drops are retried.
+            if shown or attempt == OPENROUTER_MAX_ATTEMPTS - 1:
+                raise
+            delay = openrouter_retry_delay(attempt)
+            logger.warning("OpenRouter connection failed (%s), retrying in %.2fs (attempt %s/%s)", e, delay, attempt + 1, OPENROUTER_MAX_ATTEMPTS)
+        await asyncio.sleep(delay)
+
+async def fetch_openrouter_content(data: dict, on_partial=None) -> tuple[str, str | None]:
+    """Returns (content, finish_reason) for one completion, streamed to on_partial if given."""
+    if on_partial is not None:
+        return await stream_openrouter_content(data, on_partial)
+    response = await post_to_openrouter(data)
+    payload = orjson.loads(response.content)
+    log_prompt_cache_usage(payload)
+    choice = payload["choices"][0]
+    return choice["message"]["content"], choice.get("finish_reason")
+
+@lru_cache(maxsize=256)
+def parse_ai_response(content: str) -> tuple[str, str, str, str]:
+    """Turns the raw AI reply into (response, category, summary, action). Pure, so repeated replies hit the cache."""
+    parsed = extract_json_object(content)
+    return (
+        parsed.get('response', "I'm having a little trouble thinking. Could you please rephrase?"),
+        parsed.get('category', 'Admin'),
+        parsed.get('summary', 'No summary due to response error.'),
+        parsed.get('action', 'CONTINUE').upper()
+    )
 
-async def query_openrouter(history: list) -> tuple[str, str, str, str]:
-    """Queries OpenRouter and handles potential JSON decoding errors."""
-    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
-    for turn in history:
+def normalize_for_cache(text: str) -> str:
+    """Casefolds and strips punctuation, filler words and extra whitespace, so trivially reworded repeats share a cache key."""
+    return " ".join(word for word in CACHE_PUNCTUATION_RE.sub("", text.casefold()).split() if word not in CACHE_FILLER_WORDS)
+
+def is_cacheable_conversation(messages: list) -> bool:
+    """True when the opening turn (messages[1], always kept by trimming) is the bot's own admin or prescription category marker."""
+    return len(messages) > 1 and messages[1]['content'] in CACHEABLE_OPENING_TURNS
+
+def response_cache_key(model: str, max_tokens: int, messages: list) -> str:
+    """Hashes the system prompt version, the model settings and every later message, including any rolling summary, exactly as sent."""
+    relevant = [SYSTEM_PROMPT_HASH, model, max_tokens, [(turn['role'], normalize_for_cache(turn['content'])) for turn in messages[1:]]]
+    return hashlib.sha256(orjson.dumps(relevant)).hexdigest()
+
+def lookup_cached_response(cache_key: str) -> tuple[str, str, str, str] | None:
+    """Checks the in-memory LRU first, then the optional SQLite cache. Entries older than the TTL are ignored in both."""
+    if not RESPONSE_CACHE_ENABLED:
+        return None
+    oldest_allowed = int(time.time()) - RESPONSE_CACHE_TTL
+    cached = RESPONSE_CACHE.get(cache_key)
+    if cached:
+        if cached[0] > oldest_allowed:
+            RESPONSE_CACHE.move_to_end(cache_key)
+            return cached[1]
+        del RESPONSE_CACHE[cache_key]
+    if RESPONSE_CACHE_DB is None:
+        return None
+    try:
+        row = RESPONSE_CACHE_DB.execute(
+            "SELECT response, category, summary, action, created_at FROM response_cache WHERE key = ? AND created_at > ?",
+            (cache_key, oldest_allowed)
+        ).fetchone()
+    except sqlite3.Error as e:
+        logger.error("Response cache lookup failed: %s", e)
+        return None
+    if not row:
+        return None
+    result = tuple(row[:4])
+    remember_response(cache_key, result, created_at=row[4])
+    return result
+
+def remember_response(cache_key: str, result: tuple[str, str, str, str], created_at: int | None = None):
+    """Caches a successful reply. Pass created_at for a row that came from SQLite, so it keeps its original age and is not written back."""
+    if not RESPONSE_CACHE_ENABLED or result[3] in UNCACHEABLE_ACTIONS or any(word in result[1].lower() for word in UNCACHEABLE_CATEGORY_WORDS):
+        return
+    persist = created_at is None
+    RESPONSE_CACHE[cache_key] = (int(time.time()) if persist else created_at, result)
+    RESPONSE_CACHE.move_to_end(cache_key)
+    if len(RESPONSE_CACHE) > RESPONSE_CACHE_SIZE:
+        RESPONSE_CACHE.popitem(last=False)
+    if persist and RESPONSE_CACHE_DB is not None:
+        try:
+            RESPONSE_CACHE_DB.execute("INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?, ?, ?)", (cache_key, *result, int(time.time())))
+            RESPONSE_CACHE_DB.commit()
+            if time.monotonic() - RESPONSE_CACHE_LAST_PURGE > RESPONSE_CACHE_PURGE_INTERVAL:
+                purge_expired_responses(RESPONSE_CACHE_DB)
+        except sqlite3.Error as e:
+            logger.error("Response cache write failed: %s", e)
+
+async def query_openrouter(history: list, model: str = OPENROUTER_MODEL, max_tokens: int = OPENROUTER_MAX_TOKENS, on_partial=None, rolling_summary: str | None = None) -> tuple[str, str, str, str]:
+    """Queries OpenRouter and handles potential JSON decoding errors. Streams the reply text to on_partial if given."""
+    use_summary = bool(rolling_summary) and len(history) > ROLLING_SUMMARY_THRESHOLD
+    messages = [SYSTEM_MESSAGE]
+    recent = fit_history_to_budget(trim_history(history, SUMMARISED_HISTORY_WINDOW if use_summary else OPENROUTER_HISTORY_WINDOW), OPENROUTER_HISTORY_CHAR_BUDGET)
+    for index, turn in enumerate(recent):
         role = 'assistant' if turn['role'] == 'indie' else 'user'
         messages.append({"role": role, "content": turn['text']})
+        if index == 0 and use_summary:
+            # Older turns are dropped; the summary sits right after the opening context turn in their place.
+            messages.append({"role": "system", "content": f"Prior conversation summary: {rolling_summary}"})
     
-    headers = {"Authorization": f"Bearer {OPENROUTER_API_KEY}", "Content-Type": "application/json"}
-    data = {"model": "openai/gpt-4o-mini", "messages": messages, "response_format": {"type": "json_object"}}
+    data = {**OPENROUTER_BASE_PAYLOAD, "model": model, "messages": messages, "max_tokens": max_tokens}
+    if model.startswith("anthropic/"):
+        # Automatic breakpoint so the cached prefix advances with the conversation.
+        data["cache_control"] = {"type": "ephemeral"}
     
-    async with httpx.AsyncClient() as client:
+    # Only admin and prescription chats are cached; anything else (clinical, wellness, pre-consent) may be safety-critical.
+    cache_key = response_cache_key(model, max_tokens, messages) if is_cacheable_conversation(messages) else None
+    cached = lookup_cached_response(cache_key) if cache_key else None
+    if cached:
+        logger.info("Serving AI response from cache.")
+        return cached
+
+    try:
+        content, finish_reason = await fetch_openrouter_content(data, on_partial)
+        if finish_reason == "length" and max_tokens < OPENROUTER_TRUNCATED_RETRY_MAX_TOKENS:
+            # Cut-off JSON would only become the technical-issue fallback (overwriting any streamed text), so ask once more with room to finish.
+            logger.warning("OpenRouter reply hit max_tokens=%s; retrying with %s", max_tokens, OPENROUTER_TRUNCATED_RETRY_MAX_TOKENS)
+            content, finish_reason = await fetch_openrouter_content({**data, "max_tokens": OPENROUTER_TRUNCATED_RETRY_MAX_TOKENS}, on_partial)
+        
+        # --- START OF THE FIX ---
+        # Try to parse the JSON, but handle errors gracefully if the AI response is not valid JSON
         try:
-            response = await client.post("https://openrouter.ai/api/v1/chat/completions", headers=headers, json=data, timeout=30)
-            response.raise_for_status()
-            content = response.json()["choices"][0]["message"]["content"]
-            
-            # --- START OF THE FIX ---
-            # Try to parse the JSON, but handle errors gracefully if the AI response is not valid JSON
-            try:
-                parsed = json.loads(content)
-                return (
-                    parsed.get('response', "I'm having a little trouble thinking. Could you please rephrase?"),
-                    parsed.get('category', 'Admin'),
-                    parsed.get('summary', 'No summary due to response error.'),
-                    parsed.get('action', 'CONTINUE').upper()
-                )
-            except json.JSONDecodeError:
-                logger.error(f"JSONDecodeError: Failed to parse AI response. Content was: {content}")
-                # Provide a safe fallback response to the user
-                return "I'm sorry, I seem to be having a technical issue. Could you try asking that again in a different way?", "Admin", "AI response was not valid JSON.", "CONTINUE"
-            # --- END OF THE FIX ---
-
-        except httpx.HTTPStatusError as e:
-            logger.error(f"HTTPStatusError in query_openrouter: {e.response.status_code} - {e.response.text}")
-            return "A technical issue occurred while connecting to the AI service.", "Admin", "HTTP Error", "CONTINUE"
-        except Exception as e:
-            logger.error(f"An unexpected error occurred in query_openrouter: {e}", exc_info=True)
-            return "An unexpected technical issue occurred.", "Admin", "Unhandled error", "CONTINUE"
+            result = parse_ai_response(content)
+        except orjson.JSONDecodeError:
+            logger.error("JSONDecodeError: Failed to parse AI response. Content was: %s", content)
+            # Provide a safe fallback response to the user
+            return "I'm sorry, I seem to be having a technical issue. Could you try asking that again in a different way?", "Admin", "AI response was not valid JSON.", "CONTINUE"
+        # Only successful replies are cached; the error fallbacks above and below must never be replayed.
+        if cache_key:
+            remember_response(cache_key, result)
+        return result
+        # --- END OF THE FIX ---
+
+    except httpx.HTTPStatusError as e:
+        logger.error("HTTPStatusError in query_openrouter: %s - %s", e.response.status_code, e.response.text)
+        return "A technical issue occurred while connecting to the AI service.", "Admin", "HTTP Error", "CONTINUE"
+    except Exception as e:
+        logger.error("An unexpected error occurred in query_openrouter: %s", e, exc_info=True)
+        return "An unexpected technical issue occurred.", "Admin", "Unhandled error", "CONTINUE"
+
+async def reply_with_streamed_ai(update: Update, context: ContextTypes.DEFAULT_TYPE, history: list) -> tuple[str, str, str, str]:
+    """Queries OpenRouter with streaming and shows the reply as a single Telegram message edited as text arrives."""
+    sent = None
+    last_edit = 0.0
+    streamed = False
+
+    async def show_partial(text: str):
+        nonlocal sent, last_edit, streamed
+        streamed = True
+        text = text.strip()
+        now = time.monotonic()
+        if not text or (sent is not None and now - last_edit < STREAM_EDIT_INTERVAL):
+            return
+        try:
+            sent = await update.message.reply_text(text) if sent is None else await sent.edit_text(text)
+            last_edit = now
+        except TelegramError as e:
+            logger.warning("Could not update streamed reply: %s", e)
+
+    result = await query_openrouter(history, on_partial=show_partial, rolling_summary=context.user_data.get(ROLLING_SUMMARY_KEY))
+    # Cache hits never stream, and their summary was written for whichever conversation first produced the reply.
+    if streamed and len(history) > ROLLING_SUMMARY_THRESHOLD and result[2] not in AI_ERROR_SUMMARIES and len(result[2]) >= ROLLING_SUMMARY_MIN_CHARS:
+        context.user_data[ROLLING_SUMMARY_KEY] = result[2]
+    final_text = result[0].strip()
+    if sent is None:
+        await update.message.reply_text(final_text)
+    elif sent.text != final_text:
+        await sent.edit_text(final_text)
+    return result
+
+async def continue_clinic_chat(update: Update, context: ContextTypes.DEFAULT_TYPE, user_message: str):
+    """Adds the patient's message to the clinic chat, streams Indie's reply and moves to confirmation when a report is ready."""
+    history = context.user_data.get(HISTORY_KEY, [])
+    history.append({"role": "user", "text": user_message})
+    await update.message.chat.send_action("typing")
+    ai_response_text, category, summary, action = await reply_with_streamed_ai(update, context, history)
+    history.append({"role": "indie", "text": ai_response_text})
+    context.user_data[HISTORY_KEY] = history
+    if action == "REPORT":
+        context.user_data[TEMP_REPORT_KEY] = {'category': category, 'summary': summary}
+        context.user_data[STATE_KEY] = STATE_AWAITING_CONFIRMATION
+        await update.message.reply_text(f"---\n**Query Summary**\n---\nPlease review:\n\n**Summary:** *{summary}*\n\nIs this correct? (Yes/No)")
 
 # ...
 # (The rest of your main.py file remains the same)
@@ -249,10 +833,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "👋 Welcome to Indra Clinic! I’m Indie, your digital assistant.\n\n"
         "**Purpose of this Chat:** While I cannot provide medical advice, we can either talk about wellness or I can securely gather information "
-        "about your administrative or clinical query for our team to review."
+        "about your administrative or clinical query for our team to review.\n\n"
+        "Would you like to explore **Wellness** resources, or connect with the **Clinic**?"
     )
-    await asyncio.sleep(1.5)
-    await update.message.reply_text("Would you like to explore **Wellness** resources, or connect with the **Clinic**?")
     context.user_data[STATE_KEY] = STATE_AWAITING_CHOICE
 
 async def wellness_day_end_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -271,7 +854,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message or not update.message.text: return
     current_state = context.user_data.get(STATE_KEY)
     user_message = update.message.text.strip()
-    choice = user_message.lower()
+    choice = " ".join(user_message.casefold().split()) # Lowercased once, with runs of whitespace collapsed, for every keyword check below
     
     if current_state == STATE_AWAITING_CHOICE:
         if 'clinic' in choice:
@@ -285,7 +868,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "**Data Handling & Your Privacy**\n"
                 "• **Purpose:** The information you provide is used solely for administrative and clinical support to manage your query.\n"
                 "• **Verification:** We will ask for your email and Date of Birth to securely identify you.\n"
-                "• **AI Assistance:** We use a secure, third-party AI (`openai/gpt-4o-mini` via OpenRouter) to understand your request. All data is encrypted, and the AI is isolated—it cannot access your medical records.\n"
+                f"• **AI Assistance:** We use a secure, third-party AI ({DISCLOSED_AI_MODELS} via OpenRouter) to understand your request. All data is encrypted, and the AI is isolated—it cannot access your medical records.\n"
                 "• **Medical Record:** A summary of this conversation will be added to your patient file on our EMR system (Semble).\n"
                 "• **Confirmation:** Upon completion, you will receive a confirmation email and will be offered a copy of the transcript for your records.\n\n"
                 "By typing **'I agree'**, you acknowledge you have read this information and are ready to proceed. If you have any questions before starting, please feel free to ask."
@@ -320,7 +903,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             context.user_data[STATE_KEY] = STATE_WELLNESS_JOURNEY_MENU
             await update.message.reply_text("Which day would you like to explore?\n\n1. Day 1 – Stress\n2. Day 2 – Sleep\n3. Day 3 – Movement\n4. Day 4 – Nutrition\n5. Day 5 – Attitude\n6. Day 6 – Happiness\n7. Day 7 – Habits")
         elif 'struggling' in choice:
+            if await ai_rate_limited(update): return
             context.user_data[STATE_KEY] = STATE_WELLNESS_STRUGGLES_CHAT_ACTIVE
+            context.user_data.pop(ROLLING_SUMMARY_KEY, None)
             context.user_data[HISTORY_KEY] = [
                 {"role": "user", "text": "Context: User is in the Wellness 'Struggles' Flow. Start by asking them what feels hardest, using the Maté-inspired menu from your instructions."}
             ]
@@ -526,16 +1111,16 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await wellness_day_end_message(update, context)
         
     elif current_state == STATE_WELLNESS_STRUGGLES_CHAT_ACTIVE:
+        if await ai_rate_limited(update): return
         history = context.user_data.get(HISTORY_KEY, [])
         history.append({"role": "user", "text": user_message})
         await update.message.chat.send_action("typing")
-        ai_response_text, _, summary, action = await query_openrouter(history)
+        ai_response_text, _, summary, action = await reply_with_streamed_ai(update, context, history)
         history.append({"role": "indie", "text": ai_response_text})
-        context.user_data[HISTORY_KEY] = history
-        await update.message.reply_text(ai_response_text)
+        context.user_data[HISTORY_KEY] = trim_history(history, MAX_WELLNESS_HISTORY)
         
         if action == "REPORT":
-            logger.warning(f"Wellness Red Flag detected. Summary: {summary}")
+            logger.warning("Wellness Red Flag detected. Summary: %s", summary)
             await update.message.reply_text("If you need to speak with the clinic or explore wellness again, please restart by typing /start.")
             context.user_data.clear()
         # #### START OF NEW CODE ####
@@ -546,51 +1131,64 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # #### END OF NEW CODE ####
 
     elif current_state == STATE_AWAITING_CONSENT:
-        if user_message.lower() == 'i agree':
+        if choice in CONSENT_REPLIES:
             context.user_data[STATE_KEY] = STATE_AWAITING_EMAIL
             await update.message.reply_text("Thank you. To begin, please provide the **email address you registered with Indra Clinic**.")
         else:
+            if await ai_rate_limited(update): return
             await update.message.chat.send_action("typing")
             pre_consent_history = [{"role": "user", "text": f"Context: The user has not yet consented... The user's question is: '{user_message}'"}]
-            ai_response_text, _, _, _ = await query_openrouter(pre_consent_history)
+            ai_response_text, _, _, _ = await query_openrouter(pre_consent_history, model=OPENROUTER_LIGHT_MODEL, max_tokens=OPENROUTER_SHORT_MAX_TOKENS)
             await update.message.reply_text(ai_response_text)
             await asyncio.sleep(1.5)
             await update.message.reply_text("I hope that clarifies things. To continue, please type **'I agree'**.")
     elif current_state == STATE_AWAITING_EMAIL:
-        if '@' in user_message and '.' in user_message:
+        if EMAIL_RE.fullmatch(user_message):
             context.user_data[EMAIL_KEY] = user_message
             context.user_data[STATE_KEY] = STATE_AWAITING_PATIENT_ID
             await update.message.reply_text("Thank you. Please also provide your **Patient ID**.")
         else: await update.message.reply_text("That doesn't look like a valid email. Please try again.")
     elif current_state == STATE_AWAITING_PATIENT_ID:
-        if len(user_message) >= 8:
+        if PATIENT_ID_RE.fullmatch(user_message):
             context.user_data[PATIENT_ID_KEY] = user_message
             context.user_data[STATE_KEY] = STATE_AWAITING_CATEGORY
             context.user_data[HISTORY_KEY] = []
+            context.user_data.pop(ROLLING_SUMMARY_KEY, None)
             await update.message.reply_text(f"Thank you. Details noted.\n\nPlease select a category:\n1. **Administrative**\n2. **Prescription/Medication**\n3. **Clinical/Medical**")
         else: await update.message.reply_text("That Patient ID does not look right. Please try again.")
     elif current_state == STATE_AWAITING_CATEGORY:
-        cleaned_message = user_message.lower()
-        if any(word in cleaned_message for word in ['1', 'admin']):
+        choice_match = CATEGORY_CHOICE_RE.search(choice)
+        category_choice = CATEGORY_CHOICES[choice_match.group(1)] if choice_match else guess_category(choice)
+        if category_choice and not choice_match:
+            # The patient described their query instead of picking a number: route it and keep what they wrote.
+            if category_choice == 'admin' and APPOINTMENT_CHANGE_RE.search(choice):
+                context.user_data[HISTORY_KEY].extend([{"role": "user", "text": CATEGORY_OPENING_TURNS['admin']}, {"role": "user", "text": user_message}])
+                context.user_data[STATE_KEY] = STATE_ADMIN_AWAITING_CURRENT_APPT
+                await update.message.reply_text("To change an appointment, what is the date and time of your **current** appointment?")
+                return
+            if await ai_rate_limited(update): return
+            context.user_data[STATE_KEY] = STATE_CHAT_ACTIVE
+            context.user_data[HISTORY_KEY].append({"role": "user", "text": CATEGORY_OPENING_TURNS[category_choice]})
+            await continue_clinic_chat(update, context, user_message)
+        elif category_choice == 'admin':
             context.user_data[STATE_KEY] = STATE_ADMIN_SUB_CATEGORY
             await update.message.reply_text("Understood. Is your administrative query about **Appointments** or **Something else**?")
-        elif any(word in cleaned_message for word in ['2', 'prescription']):
+        elif category_choice == 'prescription':
             context.user_data[STATE_KEY] = STATE_CHAT_ACTIVE
-            context.user_data[HISTORY_KEY].append({"role": "user", "text": "Category: Prescription/Medication."})
+            context.user_data[HISTORY_KEY].append({"role": "user", "text": CATEGORY_OPENING_TURNS['prescription']})
             await update.message.reply_text("Thank you. Please describe your prescription request.")
-        elif any(word in cleaned_message for word in ['3', 'clinical']):
+        elif category_choice == 'clinical':
             context.user_data[STATE_KEY] = STATE_CHAT_ACTIVE
-            context.user_data[HISTORY_KEY].append({"role": "user", "text": "Category: Clinical/Medical."})
+            context.user_data[HISTORY_KEY].append({"role": "user", "text": CATEGORY_OPENING_TURNS['clinical']})
             await update.message.reply_text("Thank you. Please describe the clinical issue.")
         else: await update.message.reply_text("I don't understand. Please reply with a number (1-3).")
     elif current_state == STATE_ADMIN_SUB_CATEGORY:
-        cleaned_message = user_message.lower()
-        if 'appointment' in cleaned_message:
+        if 'appointment' in choice:
             context.user_data[STATE_KEY] = STATE_ADMIN_AWAITING_CURRENT_APPT
             await update.message.reply_text("To change an appointment, what is the date and time of your **current** appointment?")
-        elif 'something else' in cleaned_message or 'else' in cleaned_message:
+        elif 'something else' in choice or 'else' in choice:
             context.user_data[STATE_KEY] = STATE_CHAT_ACTIVE
-            context.user_data[HISTORY_KEY].append({"role": "user", "text": "Category: Administrative (Other)."})
+            context.user_data[HISTORY_KEY].append({"role": "user", "text": CATEGORY_OPENING_TURNS['admin']})
             await update.message.reply_text("Thank you. Please describe your administrative request.")
         else:
             await update.message.reply_text("I didn't understand. Please reply with 'Appointments' or 'Something else'.")
@@ -604,51 +1202,65 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         summary = f"Patient requests to change their appointment from '{current_appt}' to '{new_appt}'."
         context.user_data[TEMP_REPORT_KEY] = {'category': 'Admin', 'summary': summary}
         context.user_data[STATE_KEY] = STATE_AWAITING_CONFIRMATION
-        context.user_data[HISTORY_KEY] = []
+        history = context.user_data.get(HISTORY_KEY, [])
+        if history:
+            # A free-text request opened this flow: keep it, plus the times collected since, for the transcript and any corrections.
+            history.append({"role": "user", "text": f"Current appointment: {current_appt}. Requested new appointment: {new_appt}."})
+        context.user_data[HISTORY_KEY] = history
         await update.message.reply_text(f"---\n**Query Summary**\n---\nPlease review:\n\n**Summary:** *{summary}*\n\nIs this correct? (Yes/No)")
     elif current_state == STATE_CHAT_ACTIVE:
         history = context.user_data.get(HISTORY_KEY, [])
-        history.append({"role": "user", "text": user_message})
-        await update.message.chat.send_action("typing")
-        ai_response_text, category, summary, action = await query_openrouter(history)
-        history.append({"role": "indie", "text": ai_response_text})
-        context.user_data[HISTORY_KEY] = history
-        await update.message.reply_text(ai_response_text)
-        if action == "REPORT":
-            context.user_data[TEMP_REPORT_KEY] = {'category': category, 'summary': summary}
-            context.user_data[STATE_KEY] = STATE_AWAITING_CONFIRMATION
-            await update.message.reply_text(f"---\n**Query Summary**\n---\nPlease review:\n\n**Summary:** *{summary}*\n\nIs this correct? (Yes/No)")
+        if history and history[-1]['text'].startswith("Category:") and ACKNOWLEDGEMENT_RE.fullmatch(choice):
+            await update.message.reply_text("Please describe your query in a sentence or two so our team can help.")
+            return
+        if await ai_rate_limited(update): return
+        await continue_clinic_chat(update, context, user_message)
     elif current_state == STATE_AWAITING_CONFIRMATION:
-        confirmation = user_message.lower()
-        if confirmation in ['yes', 'y', 'correct', 'confirm']:
+        if choice in CONFIRM_YES_REPLIES:
             report_data = context.user_data.get(TEMP_REPORT_KEY)
             try:
                 await update.message.reply_text("Finalising your request, please wait...")
-                transcript_for_semble, transcript_for_email = await asyncio.to_thread(
-                    send_initial_emails_and_generate_transcripts,
-                    context.user_data.get(PATIENT_ID_KEY),
-                    context.user_data.get(EMAIL_KEY),
+                transcript_for_semble, transcript_for_email = generate_transcripts(
                     context.user_data.get(SESSION_ID_KEY),
                     context.user_data.get(HISTORY_KEY, []),
-                    report_data['category'],
                     report_data['summary']
                 )
                 context.user_data[TRANSCRIPT_KEY] = transcript_for_email
+                # Emails go out in the background while we wait on Semble, so staff get the report even if the EMR push fails.
+                if SMTP_CONFIGURED:
+                    run_in_background(
+                        asyncio.to_thread(
+                            send_initial_emails,
+                            context.user_data.get(PATIENT_ID_KEY),
+                            context.user_data.get(EMAIL_KEY),
+                            context.user_data.get(SESSION_ID_KEY),
+                            transcript_for_email,
+                            report_data['category'],
+                            report_data['summary']
+                        ),
+                        "report emails"
+                    )
+                else:
+                    logger.warning("SMTP is not configured; report for session %s was not emailed.", context.user_data.get(SESSION_ID_KEY))
                 await push_to_semble(
                     context.user_data.get(EMAIL_KEY),
                     report_data['category'],
                     report_data['summary'],
                     transcript_for_semble
                 )
-                context.user_data[STATE_KEY] = STATE_AWAITING_TRANSCRIPT_CHOICE
-                await update.message.reply_text("Thank you, your query has been logged... A confirmation has been sent to your email.\n\nWould you like a copy of the full conversation transcript emailed to you? (Yes/No)")
+                if SMTP_CONFIGURED:
+                    context.user_data[STATE_KEY] = STATE_AWAITING_TRANSCRIPT_CHOICE
+                    await update.message.reply_text("Thank you, your query has been logged... A confirmation email is on its way to you.\n\nWould you like a copy of the full conversation transcript emailed to you? (Yes/No)")
+                else:
+                    context.user_data[STATE_KEY] = STATE_AWAITING_NEW_QUERY
+                    await update.message.reply_text("Thank you, your query has been logged and our team will review it. We are unable to send emails at the moment, so you will not receive a confirmation email.\n\nIs there anything else I can help with?")
             except Exception as e:
-                logger.critical(f"CRITICAL ERROR during report dispatch: {e}", exc_info=True)
+                logger.critical("CRITICAL ERROR during report dispatch: %s", e, exc_info=True)
                 await update.message.reply_text("A critical error occurred while finalising your report.")
                 context.user_data.clear()
                 await asyncio.sleep(2)
                 await start(update, context)
-        elif confirmation in ['no', 'n', 'incorrect']:
+        elif choice in CONFIRM_NO_REPLIES:
             if not context.user_data.get(HISTORY_KEY):
                  context.user_data[STATE_KEY] = STATE_AWAITING_CATEGORY
                  await update.message.reply_text("Understood. Let's restart. Please select a category...")
@@ -658,26 +1270,22 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             await update.message.reply_text("I didn't understand. Please confirm with 'Yes' or 'No'.")
     elif current_state == STATE_AWAITING_TRANSCRIPT_CHOICE:
-        choice = user_message.lower()
-        if choice in ['yes', 'y']:
-            try:
-                await update.message.reply_text("Sending transcript now...")
-                await asyncio.to_thread(
+        if choice in TRANSCRIPT_YES_REPLIES:
+            run_in_background(
+                asyncio.to_thread(
                     send_transcript_email,
                     context.user_data.get(EMAIL_KEY),
                     context.user_data.get(TEMP_REPORT_KEY, {}).get('summary'),
                     context.user_data.get(TRANSCRIPT_KEY)
-                )
-                await update.message.reply_text("The transcript has been sent to your email.")
-            except Exception as e:
-                logger.error(f"Failed to send transcript email: {e}")
-                await update.message.reply_text("Sorry, there was an error sending the transcript.")
+                ),
+                "transcript email"
+            )
+            await update.message.reply_text("Your transcript is on its way to your email.")
         
         context.user_data[STATE_KEY] = STATE_AWAITING_NEW_QUERY
         await update.message.reply_text("Is there anything else I can help with?")
     elif current_state == STATE_AWAITING_NEW_QUERY:
-        cleaned_message = user_message.lower()
-        if any(word in cleaned_message for word in ['no', 'nope', 'bye', 'end', 'thanks']):
+        if any(word in choice for word in END_CHAT_WORDS):
             await update.message.reply_text("Thank you for using our service. Be well.")
             context.user_data.clear()
         else:
@@ -688,29 +1296,62 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
-    logger.error(f"Exception while handling an update: {context.error}", exc_info=context.error)
+    logger.error("Exception while handling an update: %s", context.error, exc_info=context.error)
+
+async def warm_openrouter_connection():
+    """Opens a pooled connection to OpenRouter so the first patient turn after a deploy skips the TLS handshake."""
+    try:
+        await HTTP_CLIENT.head(OPENROUTER_URL, headers=OPENROUTER_HEADERS, timeout=OPENROUTER_TIMEOUT)
+    except httpx.HTTPError as e:
+        logger.warning("Could not pre-warm the OpenRouter connection: %s", e)
 
 async def post_init(application: Application):
-    logger.info("Clearing any existing webhooks...")
-    await application.bot.delete_webhook(drop_pending_updates=True)
+    run_in_background(warm_openrouter_connection(), "OpenRouter connection warm-up")
+
+async def post_shutdown(application: Application):
+    if BACKGROUND_TASKS:
+        logger.info("Waiting for %s background task(s) to finish...", len(BACKGROUND_TASKS))
+        await asyncio.gather(*BACKGROUND_TASKS, return_exceptions=True)
+    logger.info("Closing shared HTTP client...")
+    await HTTP_CLIENT.aclose()
+    await asyncio.to_thread(shutdown_smtp_connection)
 
 def main() -> None:
     logger.info("--- Indra Clinic Bot Initializing ---")
     
     try:
-        app = (
+        builder = (
             Application.builder()
             .token(TELEGRAM_TOKEN)
+            .concurrent_updates(CONCURRENT_UPDATES)
+            .rate_limiter(AIORateLimiter(max_retries=TELEGRAM_RATE_LIMIT_RETRIES))
             .post_init(post_init)
-            .build()
+            .post_shutdown(post_shutdown)
         )
+        if PERSISTENCE_FILE:
+            # Only user_data is stored; it holds plain dicts and strings, flushed every minute and on shutdown.
+            builder = builder.persistence(PicklePersistence(filepath=PERSISTENCE_FILE, store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False)))
+        app = builder.build()
         app.add_error_handler(error_handler)
-        app.add_handler(CommandHandler("start", start))
-        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-        logger.info("Bot is configured. Starting polling...")
-        app.run_polling(poll_interval=1, drop_pending_updates=True)
+        app.add_handler(CommandHandler("start", serialised_per_chat(start)))
+        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, serialised_per_chat(handle_message)))
+        if WEBHOOK_URL:
+            logger.info("Bot is configured. Starting webhook on port %s...", PORT)
+            app.run_webhook(
+                listen="0.0.0.0",
+                port=PORT,
+                url_path=TELEGRAM_TOKEN,
+                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{TELEGRAM_TOKEN}",
+                secret_token=WEBHOOK_SECRET,
+                bootstrap_retries=-1,
+                drop_pending_updates=True,
+            )
+        else:
+            # run_polling deletes any existing webhook and drops pending updates while bootstrapping.
+            logger.info("Bot is configured. Starting polling...")
+            app.run_polling(poll_interval=0, timeout=POLLING_TIMEOUT, bootstrap_retries=-1, drop_pending_updates=True)
     except Exception as e:
-        logger.critical(f"FATAL ERROR during bot setup: {e}", exc_info=True)
+        logger.critical("FATAL ERROR during bot setup: %s", e, exc_info=True)
         sys.exit(1)
 
 if __name__ == "__main__":